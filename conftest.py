@@ -0,0 +1,33 @@
+import collections
+import collections.abc
+import functools
+import importlib.machinery
+import importlib.util
+import os
+
+import pytest
+
+
+@functools.lru_cache()
+def _load_automizer():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "income-statement-automizer")
+    loader = importlib.machinery.SourceFileLoader("income_statement_automizer", path)
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name, loader))
+    loader.exec_module(module)
+    return module
+
+
+@pytest.fixture
+def automizer(monkeypatch):
+    """income-statement-automizer script loaded as a module.
+
+    The script is built on namedlist which still refers to collections.Mapping and collections.Sequence, removed in
+    Python 3.10, both when it's imported and when records are created, so the aliases are provided only for the tests
+    which use the script.
+    """
+
+    for name in ("Mapping", "Sequence"):
+        if not hasattr(collections, name):
+            monkeypatch.setattr(collections, name, getattr(collections.abc, name), raising=False)
+
+    return _load_automizer()
@@ -3,11 +3,28 @@
 """Investments distribution calculator"""
 
 import argparse
+import bisect
+import csv
+import functools
+import hashlib
+import io
+import itertools
+import json
 import logging
 import math
 import operator
-
-from decimal import Decimal
+import os
+import re
+import sys
+import time
+
+try:
+    import tomllib
+except ImportError:
+    tomllib = None
+
+from decimal import Decimal, localcontext
+from fractions import Fraction
 from typing import List
 
 import requests
@@ -26,10 +43,27 @@ class Actions:
     ALL = [SHOW, REBALANCE]
 
 
+class Solvers:
+    GREEDY = "greedy"
+    OPTIMAL = "optimal"
+
+    ALL = [GREEDY, OPTIMAL]
+
+
+class Formats:
+    TEXT = "text"
+    JSONL = "jsonl"
+    CSV = "csv"
+
+    ALL = [TEXT, JSONL, CSV]
+
+
 class Currency:
     USD = "usd"
     RUB = "rub"
 
+    ALL = [USD, RUB]
+
 
 class CommissionSpec:
     def __init__(self, *, minimum, percent=None, per_share=None, maximum_percent=None):
@@ -52,6 +86,22 @@ class CommissionSpec:
 
         return max(self.__minimum, commissions)
 
+    def rate(self, price):
+        """Returns commission per share for trades which exceed the minimum commission."""
+
+        rate = Decimal()
+
+        if self.__percent is not None:
+            rate += price * self.__percent / 100
+
+        if self.__per_share is not None:
+            rate += self.__per_share
+
+        if self.__maximum_percent is not None:
+            rate = min(rate, price * self.__maximum_percent / 100)
+
+        return rate
+
 
 class Holding:
     def __init__(self, name, weight, ticker=None, shares=None, holdings=None):
@@ -152,6 +202,12 @@ class Portfolio:
         self.min_trade_volume = Decimal(min_trade_volume)
         self.free_commissions = None if free_commissions is None else Decimal(free_commissions)
 
+        # Set when the portfolio has already been validated (see validate_portfolio())
+        self.tickers = None
+
+        # Set by the optimal solver
+        self.solver_report = None
+
     def restrict_selling(self, restrict=True):
         apply_restriction(self.holdings, "selling_restricted", restrict)
         return self
@@ -184,7 +240,7 @@ def apply_restriction(holdings: List[Holding], name, value):
                 setattr(holding, name, value)
 
 
-def calculate(portfolio: Portfolio, api_key, *, fake_prices=False):
+def validate_portfolio(portfolio: Portfolio):
     tickers = set()
 
     def process(name, holdings: List[Holding]):
@@ -198,7 +254,16 @@ def calculate(portfolio: Portfolio, api_key, *, fake_prices=False):
                 tickers.add(holding.ticker)
 
     process(portfolio.name, portfolio.holdings)
-    prices = get_prices(tickers, api_key, fake_prices)
+    portfolio.tickers = tickers
+
+    return portfolio
+
+
+def calculate(portfolio: Portfolio, api_key, *, fake_prices=False, solver=Solvers.GREEDY, time_budget=1):
+    if portfolio.tickers is None:
+        validate_portfolio(portfolio)
+
+    prices = get_prices(portfolio.tickers, api_key, fake_prices)
 
     current_value = calculate_current_value(portfolio.holdings, prices)
     total_assets = current_value + portfolio.free_assets
@@ -231,9 +296,17 @@ def calculate(portfolio: Portfolio, api_key, *, fake_prices=False):
                 break
 
     free_assets = free_assets_to_distribute + portfolio.min_free_assets
+
+    if solver == Solvers.OPTIMAL:
+        portfolio.solver_report = optimize(
+            portfolio, rebalance_to, portfolio.commission_spec, portfolio.min_trade_volume, time_budget)
+
     rebalanced_value = sum(holding.value for holding in portfolio.holdings)
     commissions = calculate_total_commissions(portfolio.holdings)
 
+    if solver == Solvers.OPTIMAL:
+        free_assets = total_assets - rebalanced_value - commissions
+
     return rebalanced_value, free_assets, commissions
 
 
@@ -501,6 +574,538 @@ def limit_extra_shares_to_minimum(holding: Holding, extra_shares, min_trade_volu
     return min(extra_shares, min_extra_shares)
 
 
+class SolverReport:
+    def __init__(self, greedy_cost, greedy_feasible, cost, lower_bound, proven, elapsed):
+        self.greedy_cost = greedy_cost
+        self.greedy_feasible = greedy_feasible
+        self.cost = cost
+        self.lower_bound = lower_bound  # None if there is no feasible solution or time budget has been exceeded
+
+        # The solution is proven to be optimal or there is proven to be no feasible solution at all
+        self.proven = proven
+        self.elapsed = elapsed
+
+
+class SolverPosition:
+    """Describes all allowed share counts of a position for the optimal solver.
+
+    Cost of a share count is squared deviation from the target value (tracking error) plus commission multiplied by
+    the expected total value (so it stays an exact Decimal), spent assets are value plus commission. Commission is a
+    piecewise linear function of share count (see CommissionSpec.rate()), so any linear combination of cost and spent
+    assets is convex between the key points - all breakpoints and ends of allowed intervals.
+    """
+
+    def __init__(self, holding: Holding, target_value, window_centers, total_value, budget,
+                 commission_spec: CommissionSpec, min_trade_volume):
+        self.holding = holding
+        self.target_value = target_value
+        self.total_value = total_value
+        self.commission_spec = commission_spec
+
+        current_shares = holding.current_shares
+        min_trade_shares = max(1, math.ceil(min_trade_volume / holding.price))
+
+        # Share counts above the budget are never feasible
+        max_shares = max(current_shares, math.floor(budget / holding.price))
+
+        self.intervals = [(current_shares, current_shares)]
+        if not holding.selling_restricted and current_shares - min_trade_shares >= 0:
+            self.intervals.append((0, current_shares - min_trade_shares))
+        if not holding.buying_restricted and current_shares + min_trade_shares <= max_shares:
+            self.intervals.append((current_shares + min_trade_shares, max_shares))
+        self.intervals.sort()
+
+        breakpoints = [target_value / holding.price]
+
+        rate = commission_spec.rate(holding.price)
+        if rate:
+            minimum_commission_shares = commission_spec.calculate(0, holding.price) / rate
+            breakpoints.extend((current_shares - minimum_commission_shares, current_shares + minimum_commission_shares))
+
+        key_points = set()
+        for start, end in self.intervals:
+            key_points.update((start, end))
+
+        for breakpoint in breakpoints:
+            key_points.update((math.floor(breakpoint), math.ceil(breakpoint)))
+
+        self.window = set(shares for shares in key_points if self.is_allowed(shares))
+        self.__values = {}
+        for center in window_centers:
+            self.extend_window(math.floor(center) - OPTIMAL_SOLVER_WINDOW, math.ceil(center) + OPTIMAL_SOLVER_WINDOW)
+
+    def is_allowed(self, shares):
+        return any(start <= shares <= end for start, end in self.intervals)
+
+    def extend_window(self, start, end):
+        for interval_start, interval_end in self.intervals:
+            self.window.update(range(max(start, interval_start), min(end, interval_end) + 1))
+
+    def get_gaps(self):
+        """Returns ranges of allowed share counts which are out of the window."""
+
+        window = sorted(self.window)
+        gaps = []
+
+        for start, end in self.intervals:
+            previous = start - 1
+
+            for shares in window[bisect.bisect_left(window, start):bisect.bisect_right(window, end)]:
+                if shares > previous + 1:
+                    gaps.append((previous + 1, shares - 1))
+                previous = shares
+
+            if previous < end:
+                gaps.append((previous + 1, end))
+
+        return gaps
+
+    def get_gap_minimum(self, start, end, multiplier: Fraction):
+        """Returns share counts where cost + multiplier * spent may reach its minimum within the gap."""
+
+        points = {start, end}
+
+        if end > start:
+            # Commission is linear within a gap, so the function is a convex parabola here. The integer minimum is next
+            # to the vertex, so the tiny error of the high precision calculation can't make us miss it.
+            with localcontext() as context:
+                context.prec = 100
+
+                price = self.holding.price
+                commission_rate = (self.__get_commission(end) - self.__get_commission(start)) / (end - start)
+                vertex = self.target_value / price - (
+                    self.total_value * commission_rate +
+                    Decimal(multiplier.numerator) / multiplier.denominator * (price + commission_rate)
+                ) / (2 * price * price)
+
+            for shares in (math.floor(vertex), math.ceil(vertex)):
+                points.add(min(end, max(start, shares)))
+
+        return sorted(points)
+
+    def evaluate(self, shares):
+        try:
+            return self.__values[shares]
+        except KeyError:
+            pass
+
+        with localcontext() as context:
+            context.prec = 100
+
+            value = shares * self.holding.price
+            commission = self.__get_commission(shares)
+            result = (value - self.target_value) ** 2 + self.total_value * commission, value + commission
+
+        self.__values[shares] = result
+        return result
+
+    def __get_commission(self, shares):
+        if shares == self.holding.current_shares:
+            return Decimal()
+
+        return self.commission_spec.calculate(abs(shares - self.holding.current_shares), self.holding.price)
+
+
+# How many shares around the restriction-corrected target and the greedy solution are initially tried by the optimal
+# solver
+OPTIMAL_SOLVER_WINDOW = 2
+
+
+def optimize(portfolio: Portfolio, expected_total_value, commission_spec: CommissionSpec, min_trade_volume,
+             time_budget):
+    """Searches for share counts minimizing tracking error against expected weights plus total commission.
+
+    Tracking error is measured as sum of squared deviations from the expected position values divided by the expected
+    total value. Runs a branch and bound over windows of share counts around each position's restriction-corrected
+    target and greedy solution under the same restrictions as the greedy algorithm. The result is proven to be optimal
+    for the whole problem only when no share count outside of the windows is able to improve it according to the
+    Lagrangian bound of the full problem - otherwise the windows are extended and the search is repeated until time
+    budget is exceeded. The greedy solution is kept if the solver isn't able to find a better one.
+    """
+
+    start_time = time.monotonic()
+    deadline = start_time + time_budget
+    budget = expected_total_value
+
+    # All costs are multiplied by the expected total value to keep them exact
+    scale = expected_total_value if expected_total_value > 0 else Decimal(1)
+
+    positions = [
+        SolverPosition(holding, expected_total_value * expected_weight, (
+            expected_total_value * weight / holding.price, holding.shares,
+        ), scale, budget, commission_spec, min_trade_volume)
+        for holding, expected_weight, weight in get_flat_holdings(portfolio.holdings)
+    ]
+
+    greedy_cost = sum(
+        (position.holding.value - position.target_value) ** 2 + scale * position.holding.commission
+        for position in positions)
+    greedy_feasible = sum(position.holding.value + position.holding.commission for position in positions) <= budget
+
+    best_shares = None
+    if greedy_feasible and all(position.holding.shares in position.window for position in positions):
+        best_shares = [int(position.holding.shares) for position in positions]
+
+    lower_bound = None
+    proven = False
+    step = OPTIMAL_SOLVER_WINDOW
+
+    while time.monotonic() < deadline:
+        candidates = [sorted(position.window) for position in positions]
+        candidate_indexes = [{shares: index for index, shares in enumerate(shares_list)} for shares_list in candidates]
+        values = [[position.evaluate(shares) for shares in shares_list]
+                  for position, shares_list in zip(positions, candidates)]
+
+        # Integer arithmetic is much faster than Decimal and gives us exact bounds
+        exponent = budget.as_tuple().exponent
+        for position_values in values:
+            for cost, spent in position_values:
+                exponent = min(exponent, cost.as_tuple().exponent, spent.as_tuple().exponent)
+
+        def to_integer(value):
+            # Decimal.scaleb() would round the value to the context precision
+            value_numerator, value_denominator = value.as_integer_ratio()
+            return value_numerator * 10 ** -exponent // value_denominator
+
+        items = [[(to_integer(cost), to_integer(spent)) for cost, spent in position_values]
+                 for position_values in values]
+        integer_budget = to_integer(budget)
+
+        if time.monotonic() >= deadline:
+            break
+
+        # Minimum spendings are always reached at key points which are always in the windows, so if there is no
+        # feasible solution within the windows, there is no feasible solution at all.
+        _, multiplier, lp_choices = solve_lp_relaxation(items, integer_budget)
+        if multiplier is None:
+            log.debug("Optimal solver: there is no feasible solution.")
+            proven = True
+            break
+
+        # Lagrangian bound of the full problem: for each position find the minimum of cost + multiplier * spent over
+        # all allowed share counts, both within the window and out of it.
+        gap_values = [[
+            (shares, position.evaluate(shares))
+            for start, end in position.get_gaps() for shares in position.get_gap_minimum(start, end, multiplier)
+        ] for position in positions]
+
+        # Values out of the windows may have more fractional digits
+        for position_gap_values in gap_values:
+            for _, (cost, spent) in position_gap_values:
+                exponent = min(exponent, cost.as_tuple().exponent, spent.as_tuple().exponent)
+
+        # Lagrangian costs are multiplied by the multiplier's denominator to keep them integer
+        numerator, denominator = multiplier.numerator, multiplier.denominator
+
+        def lagrangian_cost(cost_and_spent):
+            cost, spent = cost_and_spent
+            return denominator * to_integer(cost) + numerator * to_integer(spent)
+
+        window_minimums = [min(lagrangian_cost(value) for value in position_values) for position_values in values]
+        gap_minimums = [
+            [(shares, lagrangian_cost(value)) for shares, value in position_gap_values]
+            for position_gap_values in gap_values
+        ]
+
+        minimums = [
+            min(itertools.chain([window_minimum], (cost for _, cost in position_gap_minimums)))
+            for window_minimum, position_gap_minimums in zip(window_minimums, gap_minimums)
+        ]
+        dual_bound = sum(minimums) - numerator * to_integer(budget)
+        lower_bound = max(lower_bound or 0, Decimal(dual_bound).scaleb(exponent) / denominator / scale)
+
+        # Lagrangian relaxation prefers share counts out of the windows, so there is no point in searching the windows
+        # until they are extended.
+        outside = False
+        for position, window_minimum, position_gap_minimums in zip(positions, window_minimums, gap_minimums):
+            for shares, cost in position_gap_minimums:
+                if cost < window_minimum:
+                    position.extend_window(shares - OPTIMAL_SOLVER_WINDOW, shares + OPTIMAL_SOLVER_WINDOW)
+                    outside = True
+
+        if outside and time.monotonic() < deadline:
+            continue
+
+        best_cost, best_choices = None, None
+        for shares in (best_shares, [shares_list[choice] for shares_list, choice in zip(candidates, lp_choices)]):
+            if shares is None:
+                continue
+
+            choices = [indexes[position_shares] for indexes, position_shares in zip(candidate_indexes, shares)]
+            cost = sum(items[index][choice][0] for index, choice in enumerate(choices))
+            spent = sum(items[index][choice][1] for index, choice in enumerate(choices))
+
+            if spent <= integer_budget and (best_cost is None or cost < best_cost):
+                best_cost, best_choices = cost, choices
+
+        finished = branch_and_bound(items, integer_budget, multiplier, best_cost, best_choices, deadline)
+        best_shares = [shares_list[choice] for shares_list, choice in zip(candidates, best_choices)]
+
+        if not finished:
+            break
+
+        # Extend windows around the out of window share counts which may improve the solution
+        best_cost = denominator * sum(
+            to_integer(position.evaluate(shares)[0]) for position, shares in zip(positions, best_shares))
+        extended = False
+
+        for position, minimum, position_gap_minimums in zip(positions, minimums, gap_minimums):
+            for shares, cost in position_gap_minimums:
+                if dual_bound - minimum + cost < best_cost:
+                    position.extend_window(shares - step, shares + step)
+                    extended = True
+
+        if not extended:
+            proven = True
+            break
+
+        step *= 2
+        log.debug("Optimal solver: extending the search windows (%s share counts).",
+                  sum(len(position.window) for position in positions))
+
+    if best_shares is None:
+        best_cost = None
+    else:
+        best_cost = sum(position.evaluate(shares)[0] for position, shares in zip(positions, best_shares))
+
+    if best_cost is not None and (not greedy_feasible or best_cost < greedy_cost):
+        for position, shares in zip(positions, best_shares):
+            if shares != position.holding.shares:
+                position.holding.change("optimal solution", shares, commission_spec)
+
+                # The flags describe the trades blocked for the greedy solution, which is replaced here
+                position.holding.sell_blocked = False
+                position.holding.buy_blocked = False
+
+                # There is no trade, so there is no commission (the greedy algorithm never gets here)
+                if shares == position.holding.current_shares:
+                    position.holding.commission = 0
+
+        update_group_values(portfolio.holdings)
+    else:
+        best_cost = greedy_cost
+
+    greedy_cost /= scale
+    best_cost /= scale
+
+    # The bound is rounded to the context precision and must not exceed the cost of the optimal solution
+    if lower_bound is not None:
+        lower_bound = min(lower_bound, best_cost)
+
+    elapsed = time.monotonic() - start_time
+    log.debug("Optimal solver: cost %s (greedy: %s%s), lower bound %s, %s in %.3fs.",
+              best_cost, greedy_cost, "" if greedy_feasible else ", infeasible", lower_bound,
+              "proven" if proven else "not proven", elapsed)
+
+    return SolverReport(greedy_cost, greedy_feasible, best_cost, lower_bound, proven, elapsed)
+
+
+def get_flat_holdings(holdings: List[Holding], expected_weight=Decimal(1), weight=Decimal(1)):
+    for holding in holdings:
+        if holding.is_group:
+            yield from get_flat_holdings(
+                holding.holdings, expected_weight * holding.expected_weight, weight * holding.weight)
+        else:
+            yield holding, expected_weight * holding.expected_weight, weight * holding.weight
+
+
+def solve_lp_relaxation(items, budget):
+    """Solves LP relaxation of the multiple-choice knapsack problem.
+
+    Returns the lower bound, Lagrange multiplier for the budget constraint and a feasible rounded solution.
+    """
+
+    choices = []
+    segments = []
+    spent = 0
+    cost = 0
+
+    for index, candidates in enumerate(items):
+        # Start from the cheapest candidate and walk over the lower convex hull towards lower spendings
+        choice = min(range(len(candidates)), key=lambda candidate: (candidates[candidate][0], candidates[candidate][1]))
+        choices.append(choice)
+
+        cost += candidates[choice][0]
+        spent += candidates[choice][1]
+
+        # Build the lower convex hull of the candidates spending less (monotone chain)
+        hull = []
+        choice_spent = candidates[choice][1]
+
+        for candidate in sorted(
+            (candidate for candidate in range(len(candidates)) if candidates[candidate][1] < choice_spent),
+            key=lambda candidate: (candidates[candidate][1], candidates[candidate][0]),
+        ) + [choice]:
+            candidate_cost, candidate_spent = candidates[candidate]
+            if hull and candidates[hull[-1]][1] == candidate_spent:
+                continue
+
+            while len(hull) >= 2:
+                first_cost, first_spent = candidates[hull[-2]]
+                last_cost, last_spent = candidates[hull[-1]]
+
+                # Drop the last point if it's not below the line from the previous one to the new one
+                if (
+                    (last_cost - first_cost) * (candidate_spent - first_spent) <
+                    (candidate_cost - first_cost) * (last_spent - first_spent)
+                ):
+                    break
+
+                hull.pop()
+
+            hull.append(candidate)
+
+        for current, next_point in zip(reversed(hull), reversed(hull[:-1])):
+            current_cost, current_spent = candidates[current]
+            next_cost, next_spent = candidates[next_point]
+            segments.append((Fraction(next_cost - current_cost, current_spent - next_spent), index, next_point,
+                             current_spent - next_spent))
+
+    if spent <= budget:
+        return cost, Fraction(0), choices
+
+    lower_bound = Fraction(cost)
+    segments.sort(key=lambda segment: segment[0])
+
+    for slope, index, point, freed in segments:
+        excess = spent - budget
+
+        choices[index] = point
+        spent -= freed
+
+        if freed >= excess:
+            return lower_bound + slope * excess, slope, choices
+
+        lower_bound += slope * freed
+
+    return None, None, None
+
+
+def branch_and_bound(items, budget, multiplier: Fraction, best_cost, best_choices, deadline):
+    """Searches for the optimal solution updating best_choices in place.
+
+    Returns True if the solution is proven to be optimal or False if deadline has been reached.
+    """
+
+    numerator, denominator = multiplier.numerator, multiplier.denominator
+    count = len(items)
+
+    # Expensive positions first: they have the largest impact on the result
+    order = sorted(range(count), key=lambda index: max(spent for _, spent in items[index]), reverse=True)
+
+    levels = []
+    for index in order:
+        # Candidates which are not cheaper than some other candidate spending not more are never needed
+        candidates = []
+        for choice, (cost, spent) in sorted(enumerate(items[index]), key=lambda item: (item[1][1], item[1][0])):
+            if not candidates or cost < candidates[-1][0]:
+                candidates.append((cost, spent, denominator * cost + numerator * spent, choice))
+
+        # Candidates sorted by Lagrangian cost, so once it prunes a candidate it prunes all the next ones too
+        candidates.sort(key=lambda candidate: candidate[2])
+        levels.append(candidates)
+
+    if best_cost is None:
+        best_cost = math.inf
+    else:
+        # Reduced cost fixing: drop the candidates which can't improve the solution even if all other positions take
+        # their best candidates.
+        lagrangian_bound = sum(candidates[0][2] for candidates in levels) - numerator * budget
+        levels = [
+            [candidate for candidate in candidates
+             if lagrangian_bound - candidates[0][2] + candidate[2] < denominator * best_cost]
+            for candidates in levels
+        ]
+
+        if not all(levels):
+            return True
+
+    min_cost_suffix = [0] * (count + 1)
+    min_spent_suffix = [0] * (count + 1)
+    max_spent_suffix = [0] * (count + 1)
+    lagrangian_suffix = [0] * (count + 1)
+
+    for level in reversed(range(count)):
+        candidates = levels[level]
+        min_cost_suffix[level] = min_cost_suffix[level + 1] + min(cost for cost, _, _, _ in candidates)
+        min_spent_suffix[level] = min_spent_suffix[level + 1] + min(spent for _, spent, _, _ in candidates)
+        max_spent_suffix[level] = max_spent_suffix[level + 1] + max(spent for _, spent, _, _ in candidates)
+        lagrangian_suffix[level] = lagrangian_suffix[level + 1] + candidates[0][2]
+
+    level_costs = [0] * (count + 1)
+    level_spent = [0] * (count + 1)
+    level_choices = [0] * count
+    next_candidates = [0] * (count + 1)
+
+    level = 0
+    iterations = 0
+
+    while level >= 0:
+        iterations += 1
+        if iterations % 4096 == 0 and time.monotonic() >= deadline:
+            return False
+
+        if level == count:
+            if level_costs[level] < best_cost:
+                best_cost = level_costs[level]
+                for index, choice in zip(order, level_choices):
+                    best_choices[index] = choice
+
+            level -= 1
+            continue
+
+        candidates = levels[level]
+        candidate_id = next_candidates[level]
+
+        if candidate_id == len(candidates):
+            next_candidates[level] = 0
+            level -= 1
+            continue
+
+        next_candidates[level] = candidate_id + 1
+        cost, spent, _, choice = candidates[candidate_id]
+
+        cost += level_costs[level]
+        spent += level_spent[level]
+
+        if (
+            denominator * cost + numerator * spent + lagrangian_suffix[level + 1] - numerator * budget >=
+            denominator * best_cost
+        ):
+            next_candidates[level] = len(candidates)
+            continue
+
+        if spent + min_spent_suffix[level + 1] > budget or cost + min_cost_suffix[level + 1] >= best_cost:
+            continue
+
+        # Unspent assets increase the cost over the Lagrangian bound by multiplier for each unit
+        unspent = budget - spent - max_spent_suffix[level + 1]
+        if unspent > 0 and (
+            denominator * cost + numerator * spent + lagrangian_suffix[level + 1] - numerator * budget +
+            numerator * unspent >= denominator * best_cost
+        ):
+            continue
+
+        level_costs[level + 1] = cost
+        level_spent[level + 1] = spent
+        level_choices[level] = choice
+        level += 1
+
+    return True
+
+
+def update_group_values(holdings: List[Holding]):
+    total_value = Decimal()
+
+    for holding in holdings:
+        if holding.is_group:
+            holding.value = update_group_values(holding.holdings)
+
+        total_value += holding.value
+
+    return total_value
+
+
 def flatify(holdings: List[Holding], expected_weight, weight):
     flat_holdings = []
 
@@ -516,7 +1121,7 @@ def flatify(holdings: List[Holding], expected_weight, weight):
     return flat_holdings
 
 
-def show(action, portfolio: Portfolio, holdings: List[Holding], expected_total_value, *, depth=0):
+def show(action, portfolio: Portfolio, holdings: List[Holding], expected_total_value, lines, *, depth=0):
     for holding in sorted(holdings, key=operator.attrgetter("weight"), reverse=True):
         title = "{indent}* {name}".format(indent="  " * depth, name=colorify_name(holding.name))
         expected_value = expected_total_value * holding.weight
@@ -557,9 +1162,9 @@ def show(action, portfolio: Portfolio, holdings: List[Holding], expected_total_v
         if holding.is_group:
             title += ":"
 
-        print(title)
+        lines.append(title)
         if holding.is_group:
-            show(action, portfolio, holding.holdings, expected_value, depth=depth + 1)
+            show(action, portfolio, holding.holdings, expected_value, lines, depth=depth + 1)
 
 
 def get_weight(assets, value):
@@ -595,27 +1200,39 @@ def format_weight(weight):
 
 
 def colorify_name(string):
-    return colored(string, attrs=["bold"])
+    return colorify(string, attrs=["bold"])
 
 
 def colorify_freeze(string):
-    return colored(string, "blue")
+    return colorify(string, "blue")
 
 
 def colorify_buy(string):
-    return colored(string, "green")
+    return colorify(string, "green")
 
 
 def colorify_sell(string):
-    return colored(string, "red")
+    return colorify(string, "red")
 
 
 def colorify_weight(string):
-    return colored(string, "magenta", attrs=["bold"])
+    return colorify(string, "magenta", attrs=["bold"])
 
 
 def colorify_warning(string):
-    return colored(string, "red")
+    return colorify(string, "red")
+
+
+def colorify(string, color=None, attrs=None):
+    if not colors_enabled():
+        return string
+
+    return colored(string, color, attrs=attrs)
+
+
+@functools.lru_cache()
+def colors_enabled():
+    return sys.stdout.isatty()
 
 
 def get_prices(tickers, api_key, fake_prices):
@@ -680,31 +1297,440 @@ def get_prices(tickers, api_key, fake_prices):
     return prices
 
 
-def process_portfolio(action, portfolio: Portfolio, api_key, flat_view):
-    total_value, free_assets, commissions = calculate(portfolio, api_key, fake_prices=action == Actions.SHOW)
+# Must be incremented on any change of the compiled config representation
+CONFIG_CACHE_VERSION = 3
+
+
+class ConfigFormats:
+    TOML = "toml"
+    JSON = "json"
+
+    EXTENSIONS = {
+        ".toml": TOML,
+        ".json": JSON,
+    }
+
+
+def load_config(path, cache_dir=None):
+    """Loads portfolios from a declarative TOML/JSON config.
+
+    The compiled and validated config is cached as JSON keyed by the config's content hash, so unchanged configs are
+    loaded without parsing and validation.
+    """
+
+    config_format = ConfigFormats.EXTENSIONS.get(os.path.splitext(path)[1].lower())
+    if config_format is None:
+        raise Error("Unsupported config file type: {!r}.", path)
+
+    try:
+        with open(path, "rb") as config_file:
+            data = config_file.read()
+    except OSError as e:
+        raise Error("Error while reading {!r}: {}.", path, e.strerror)
+
+    if cache_dir is None:
+        cache_dir = get_config_cache_dir()
+
+    config_hash = hashlib.sha256("{}:{}:".format(CONFIG_CACHE_VERSION, config_format).encode() + data).hexdigest()
+    cache_path = os.path.join(cache_dir, config_hash + ".json")
+
+    try:
+        with open(cache_path, "r", encoding="utf-8") as cache_file:
+            compiled_config = json.load(cache_file)
+
+        portfolios, api_key = build_config(compiled_config)
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError, LookupError, TypeError, AttributeError, ArithmeticError, Error) as e:
+        log.warning("Failed to load compiled config from %r, recompiling it: %s", cache_path, e)
+    else:
+        log.debug("Loaded compiled %r config from %r.", path, cache_path)
+        return portfolios, api_key
+
+    try:
+        compiled_config = compile_config(parse_config(data, config_format))
+        portfolios, api_key = build_config(compiled_config)
+    except Error as e:
+        raise Error("Invalid {!r} config: {}", path, e)
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+
+        temp_path = cache_path + ".tmp{}".format(os.getpid())
+        with open(temp_path, "w", encoding="utf-8") as cache_file:
+            # Decimals are stored as strings: all of them are converted back by Portfolio and CommissionSpec
+            json.dump(compiled_config, cache_file, default=str)
+        os.replace(temp_path, cache_path)
+    except OSError as e:
+        log.warning("Failed to save compiled config to %r: %s.", cache_path, e)
+
+    return portfolios, api_key
+
+
+def get_config_cache_dir():
+    cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_dir, "investments-calc")
+
+
+def parse_config(data, config_format):
+    try:
+        text = data.decode("utf-8")
+    except UnicodeDecodeError as e:
+        raise Error("Invalid encoding: {}.", e)
+
+    if config_format == ConfigFormats.JSON:
+        try:
+            return json.loads(text, parse_float=Decimal)
+        except ValueError as e:
+            raise Error("Invalid JSON: {}.", e)
+    elif config_format == ConfigFormats.TOML:
+        if tomllib is None:
+            raise Error("TOML configs require Python 3.11+.")
+
+        try:
+            return tomllib.loads(text, parse_float=Decimal)
+        except tomllib.TOMLDecodeError as e:
+            raise Error("Invalid TOML: {}.", e)
+    else:
+        raise LogicalError()
+
+
+def compile_config(config):
+    """Validates the parsed config and returns its compiled form consisting only of plain data."""
+
+    config = ConfigSection("config", config)
+    api_key = config.get("api_key", str, "")
+    portfolios = [compile_portfolio(portfolio) for portfolio in config.get_sections("portfolios")]
+    config.ensure_no_unknown_options()
+
+    if not portfolios:
+        raise Error("No portfolios are specified.")
+
+    return {"api_key": api_key, "portfolios": portfolios}
+
+
+def compile_portfolio(config: "ConfigSection"):
+    name = config.get("name", str)
+
+    currency = config.get("currency", str)
+    if currency not in Currency.ALL:
+        raise Error("Invalid {!r} portfolio currency: {!r}.", name, currency)
+
+    commission_config = config.get_section("commission")
+    commission = {
+        "minimum": commission_config.get("minimum", Number),
+        "percent": commission_config.get("percent", Number, None),
+        "per_share": commission_config.get("per_share", Number, None),
+        "maximum_percent": commission_config.get("maximum_percent", Number, None),
+    }
+    commission_config.ensure_no_unknown_options()
+
+    compiled_portfolio = {
+        "name": name,
+        "currency": currency,
+        "commission": commission,
+        "holdings": [compile_holding(holding) for holding in config.get_sections("holdings")],
+        "free_assets": config.get("free_assets", Number),
+        "min_free_assets": config.get("min_free_assets", Number),
+        "min_trade_volume": config.get("min_trade_volume", Number, 0),
+        "free_commissions": config.get("free_commissions", Number, None),
+    }
+    compiled_portfolio.update(compile_restrictions(config))
+    config.ensure_no_unknown_options()
+
+    # Weights are validated only once - on compilation
+    portfolio = validate_portfolio(build_portfolio(compiled_portfolio))
+    compiled_portfolio["tickers"] = sorted(portfolio.tickers)
+
+    return compiled_portfolio
+
+
+def compile_holding(config: "ConfigSection"):
+    name = config.get("name", str)
+    weight = config.get("weight", str)
+    if not re.match(r"^\d+(\.\d+)?%$", weight):
+        raise Error("Invalid {!r} holding weight: {!r}.", name, weight)
+
+    ticker = config.get("ticker", str, None)
+    if ticker is not None and not re.match(r"^[A-Za-z0-9.\-]+$", ticker):
+        raise Error("Invalid {!r} holding ticker: {!r}.", name, ticker)
+
+    shares = config.get("shares", int, None)
+    if shares is not None and shares < 0:
+        raise Error("Invalid {!r} holding shares: {}.", name, shares)
+
+    compiled_holding = {
+        "name": name,
+        "weight": weight,
+        "ticker": ticker,
+        "shares": shares,
+        "holdings": [compile_holding(holding) for holding in config.get_sections("holdings", required=False)],
+    }
+    compiled_holding.update(compile_restrictions(config))
+    config.ensure_no_unknown_options()
+
+    return compiled_holding
+
+
+def compile_restrictions(config: "ConfigSection"):
+    return {
+        "restrict_selling": config.get("restrict_selling", bool, False),
+        "restrict_buying": config.get("restrict_buying", bool, False),
+    }
+
+
+def build_config(compiled_config):
+    portfolios = [build_portfolio(portfolio) for portfolio in compiled_config["portfolios"]]
+    return portfolios, compiled_config["api_key"]
+
+
+def build_portfolio(compiled_portfolio):
+    tickers = set()
+
+    portfolio = Portfolio(
+        compiled_portfolio["name"], compiled_portfolio["currency"],
+        CommissionSpec(**compiled_portfolio["commission"]),
+        holdings=[build_holding(holding, tickers) for holding in compiled_portfolio["holdings"]],
+        free_assets=compiled_portfolio["free_assets"],
+        min_free_assets=compiled_portfolio["min_free_assets"],
+        min_trade_volume=compiled_portfolio["min_trade_volume"],
+        free_commissions=compiled_portfolio["free_commissions"])
+
+    apply_compiled_restrictions(portfolio, compiled_portfolio)
+
+    # Not set for the portfolios which are being compiled at this moment
+    compiled_tickers = compiled_portfolio.get("tickers")
+
+    if compiled_tickers is not None:
+        if set(compiled_tickers) != tickers:
+            raise Error("Compiled {!r} portfolio is corrupted.", portfolio.name)
+
+        portfolio.tickers = tickers
+
+    return portfolio
+
+
+def build_holding(compiled_holding, tickers):
+    holding = Holding(
+        compiled_holding["name"], compiled_holding["weight"], compiled_holding["ticker"], compiled_holding["shares"],
+        [build_holding(holding, tickers) for holding in compiled_holding["holdings"]])
+
+    if holding.ticker is not None:
+        tickers.add(holding.ticker)
+
+    apply_compiled_restrictions(holding, compiled_holding)
+
+    return holding
+
+
+def apply_compiled_restrictions(target, compiled):
+    if compiled["restrict_selling"]:
+        target.restrict_selling()
+
+    if compiled["restrict_buying"]:
+        target.restrict_buying()
+
+
+class Number:
+    """A marker for Decimal config options which may be specified as integers, floats or strings."""
+
+
+REQUIRED = object()
+
+
+class ConfigSection:
+    def __init__(self, path, config):
+        if not isinstance(config, dict):
+            raise Error("Invalid {}: a table is expected.", path)
+
+        self.__path = path
+        self.__config = config
+        self.__used = set()
+
+    def get(self, name, value_type, default=REQUIRED):
+        self.__used.add(name)
+
+        try:
+            value = self.__config[name]
+        except KeyError:
+            if default is REQUIRED:
+                raise Error("{}.{} is missing.", self.__path, name)
+            return default
+
+        if value_type is Number:
+            if isinstance(value, bool) or not isinstance(value, (int, Decimal, str)):
+                raise Error("Invalid {}.{}: a number is expected.", self.__path, name)
+
+            try:
+                value = Decimal(value)
+            except ArithmeticError:
+                raise Error("Invalid {}.{}: {!r}.", self.__path, name, value)
+
+            if not value.is_finite():
+                raise Error("Invalid {}.{}: {!r}.", self.__path, name, value)
+        elif value_type is int:
+            if isinstance(value, bool) or not isinstance(value, int):
+                raise Error("Invalid {}.{}: an integer is expected.", self.__path, name)
+        elif not isinstance(value, value_type):
+            raise Error("Invalid {}.{}: {} is expected.", self.__path, name, value_type.__name__)
+
+        return value
+
+    def get_section(self, name):
+        return ConfigSection("{}.{}".format(self.__path, name), self.get(name, dict))
+
+    def get_sections(self, name, required=True):
+        sections = self.get(name, list, REQUIRED if required else [])
+
+        return [
+            ConfigSection("{}.{}[{}]".format(self.__path, name, index), section)
+            for index, section in enumerate(sections)
+        ]
+
+    def ensure_no_unknown_options(self):
+        unknown_options = set(self.__config) - self.__used
+        if unknown_options:
+            raise Error("Unknown {} options: {}.", self.__path, ", ".join(sorted(unknown_options)))
+
+
+class OrderExporter:
+    """Exports positions with their suggested orders as JSON Lines or CSV.
+
+    Positions are shown with fake prices, so only their expected weights are exported for them.
+    """
+
+    __columns = [
+        "portfolio", "group", "name", "ticker", "price",
+        "current_shares", "shares", "order", "order_shares", "order_value", "commission",
+        "current_value", "value", "current_weight", "weight", "expected_weight",
+        "sell_blocked", "buy_blocked",
+    ]
+
+    def __init__(self, output, output_format):
+        if output_format not in (Formats.JSONL, Formats.CSV):
+            raise LogicalError()
+
+        self.__output = output
+        self.__format = output_format
+        self.__buffer = io.StringIO()
+
+        if output_format == Formats.CSV:
+            self.__csv_writer = csv.writer(self.__buffer, lineterminator="\n")
+            self.__csv_writer.writerow(self.__columns)
+
+    def export(self, action, portfolio: Portfolio, total_value):
+        self.__export(action, portfolio, [], portfolio.holdings, total_value, Decimal(1))
+
+    def flush(self):
+        self.__output.write(self.__buffer.getvalue())
+        self.__output.flush()
+
+        self.__buffer.seek(0)
+        self.__buffer.truncate()
+
+    def __export(self, action, portfolio: Portfolio, path, holdings: List[Holding], total_value, expected_weight):
+        for holding in holdings:
+            if holding.is_group:
+                self.__export(action, portfolio, path + [holding.name], holding.holdings, total_value,
+                              expected_weight * holding.expected_weight)
+                continue
+
+            if action == Actions.SHOW:
+                row = [None] * len(self.__columns)
+                row[:4] = portfolio.name, " / ".join(path), holding.name, holding.ticker
+                row[self.__columns.index("current_shares")] = int(holding.current_shares)
+                row[self.__columns.index("expected_weight")] = format_export_weight(
+                    expected_weight * holding.expected_weight)
+
+                self.__write(row)
+                continue
+
+            order_shares = holding.shares - holding.current_shares
+            if order_shares > 0:
+                order = "buy"
+            elif order_shares < 0:
+                order = "sell"
+            else:
+                order = ""
+
+            self.__write([
+                portfolio.name, " / ".join(path), holding.name, holding.ticker, str(holding.price),
+                int(holding.current_shares), int(holding.shares), order, int(abs(order_shares)),
+                str(abs(holding.value - holding.current_value)), str(holding.commission),
+                str(holding.current_value), str(holding.value),
+                format_export_weight(get_weight(total_value, holding.current_value)),
+                format_export_weight(get_weight(total_value, holding.value)),
+                format_export_weight(expected_weight * holding.expected_weight),
+                holding.sell_blocked, holding.buy_blocked,
+            ])
+
+    def __write(self, row):
+        if self.__format == Formats.CSV:
+            # Use the same boolean literals as JSON instead of Python's True/False
+            self.__csv_writer.writerow([
+                ("true" if value else "false") if isinstance(value, bool) else value for value in row])
+        else:
+            self.__buffer.write(json.dumps(dict(zip(self.__columns, row)), ensure_ascii=False))
+            self.__buffer.write("\n")
+
+
+def format_export_weight(weight):
+    return "{:.6f}".format(weight)
+
+
+def process_portfolio(action, portfolio: Portfolio, api_key, flat_view, exporter: OrderExporter = None, *,
+                      solver=Solvers.GREEDY, time_budget=1):
+    total_value, free_assets, commissions = calculate(
+        portfolio, api_key, fake_prices=action == Actions.SHOW,
+        solver=solver if action == Actions.REBALANCE else Solvers.GREEDY, time_budget=time_budget)
     if action == Actions.SHOW:
         total_value, free_assets, commissions = portfolio.free_assets, 0, 0
 
+    if exporter is not None:
+        exporter.export(action, portfolio, total_value)
+        return
+
     if flat_view:
         portfolio.holdings = flatify(portfolio.holdings, Decimal(1), Decimal(1))
         portfolio.holdings.sort(key=lambda holding: holding.value, reverse=True)
 
-    print(colorify_name(portfolio.name + ":"))
-    show(action, portfolio, portfolio.holdings, total_value)
+    lines = [colorify_name(portfolio.name + ":")]
+    show(action, portfolio, portfolio.holdings, total_value, lines)
 
     if action == Actions.REBALANCE:
-        print()
-        print(colorify_name("Total value: ") + format_assets(total_value, portfolio.currency))
+        lines.append("")
+        lines.append(colorify_name("Total value: ") + format_assets(total_value, portfolio.currency))
 
         formatted_free_assets = format_assets(free_assets, portfolio.currency)
         if free_assets < portfolio.min_free_assets:
             formatted_free_assets = colorify_warning(formatted_free_assets)
-        print(colorify_name("Free assets: ") + formatted_free_assets)
+        lines.append(colorify_name("Free assets: ") + formatted_free_assets)
 
         formatted_commissions = format_assets(commissions, portfolio.currency)
         if portfolio.free_commissions is not None and commissions > portfolio.free_commissions:
             formatted_commissions = colorify_warning(formatted_commissions)
-        print(colorify_name("Commissions: ") + formatted_commissions)
+        lines.append(colorify_name("Commissions: ") + formatted_commissions)
+
+        report = portfolio.solver_report
+        if report is not None:
+            formatted_cost = "{cost} (greedy: {greedy_cost})".format(
+                cost=format_assets(report.cost, portfolio.currency),
+                greedy_cost=format_assets(report.greedy_cost, portfolio.currency))
+
+            if not report.greedy_feasible:
+                formatted_cost += colorify_warning(" [greedy infeasible]")
+
+            if not report.proven:
+                warning = "time budget exceeded"
+                if report.lower_bound is not None:
+                    warning += ", lower bound: " + format_assets(report.lower_bound, portfolio.currency)
+                formatted_cost += colorify_warning(" [{}]".format(warning))
+            elif report.lower_bound is None:
+                formatted_cost += colorify_warning(" [no feasible solution]")
+
+            lines.append(colorify_name("Tracking error + commissions: ") + formatted_cost)
+
+    sys.stdout.write("\n".join(lines) + "\n")
 
 
 def parse_args():
@@ -712,15 +1738,41 @@ def parse_args():
     parser.add_argument("action", choices=Actions.ALL, help="action to process")
     parser.add_argument("--debug", action="store_true", help="debug mode")
     parser.add_argument("--flat", action="store_true", help="flat view")
+    parser.add_argument("--format", choices=Formats.ALL, default=Formats.TEXT,
+                        help="output format: human-readable text or positions with orders as JSON Lines/CSV")
+    parser.add_argument("--config", metavar="PATH", help="portfolios config path (*.toml or *.json)")
+    parser.add_argument("--solver", choices=Solvers.ALL, default=Solvers.GREEDY, help="rebalancing solver")
+    parser.add_argument("--time-budget", metavar="SECONDS", type=float, default=1,
+                        help="time budget for the optimal solver")
     return parser.parse_args()
 
 
-def main(portfolios, api_key):
+def main(portfolios=None, api_key=None):
     args = parse_args()
     pcli.log.setup(level=logging.DEBUG if args.debug else logging.WARNING)
 
+    if args.config is not None:
+        if portfolios is not None:
+            raise Error("Portfolios config can't be specified for a script with predefined portfolios.")
+
+        portfolios, config_api_key = load_config(args.config)
+        if api_key is None:
+            api_key = config_api_key
+    elif portfolios is None:
+        raise Error("Portfolios config is not specified.")
+
+    exporter = None if args.format == Formats.TEXT else OrderExporter(sys.stdout, args.format)
+
     for portfolio_id, portfolio in enumerate(portfolios):
-        if portfolio_id:
+        if portfolio_id and exporter is None:
             print("\n")
 
-        process_portfolio(args.action, portfolio, api_key, args.flat)
+        process_portfolio(args.action, portfolio, api_key, args.flat, exporter,
+                          solver=args.solver, time_budget=args.time_budget)
+
+    if exporter is not None:
+        exporter.flush()
+
+
+if __name__ == "__main__":
+    main()
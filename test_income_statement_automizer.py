@@ -0,0 +1,112 @@
+import datetime
+import random
+
+from decimal import Decimal
+
+import pytest
+
+DATE = datetime.date(2018, 3, 15)
+
+
+def _decimal_dividend(automizer, value, paid_taxes, rate):
+    """Reference implementation: the Decimal calculation used before switching to integer kopecks."""
+
+    value_in_local_currency = automizer._round_currency(value * rate)
+    paid_taxes_in_local_currency = automizer._round_currency(paid_taxes * rate)
+
+    expected_taxes = automizer._round_currency(value_in_local_currency * Decimal("0.13"))
+    to_pay = max(Decimal(), expected_taxes - paid_taxes_in_local_currency)
+    real_income = value_in_local_currency - paid_taxes_in_local_currency - to_pay
+
+    return value_in_local_currency, paid_taxes_in_local_currency, to_pay, real_income
+
+
+def _check_dividend(automizer, value, paid_taxes, rate):
+    dividend = automizer.Dividend(DATE, "Issuer", value, paid_taxes=paid_taxes).calculate(rate)
+    value_in_local_currency, paid_taxes_in_local_currency, to_pay, real_income = _decimal_dividend(
+        automizer, value, paid_taxes, rate)
+
+    # String comparison to make sure that the values are encoded into the statement in exactly the same way
+    assert str(dividend.value_in_local_currency) == str(value_in_local_currency)
+    assert str(dividend.paid_taxes_in_local_currency) == str(paid_taxes_in_local_currency)
+
+    assert dividend.to_pay_kopecks == to_pay * 100
+    assert dividend.real_income_kopecks == real_income * 100
+
+
+@pytest.mark.parametrize("dividend,divisor,expected", [
+    (0, 100, 0),
+    (149, 100, 1),
+    (150, 100, 2),
+    (250, 100, 2),
+    (251, 100, 3),
+    (350, 100, 4),
+    (-150, 100, -2),
+    (-250, 100, -2),
+    (-251, 100, -3),
+    (5, 10, 0),
+    (15, 10, 2),
+])
+def test_round_division(automizer, dividend, divisor, expected):
+    assert automizer._round_division(dividend, divisor) == expected
+    assert automizer._round_division(dividend, divisor) == round(Decimal(dividend) / divisor)
+
+
+@pytest.mark.parametrize("value,paid_taxes,rate", [
+    # value * rate ends exactly with a half kopeck: rounding to even down and up
+    (Decimal("1.00"), Decimal("0.10"), Decimal("57.0050")),
+    (Decimal("1.00"), Decimal("0.10"), Decimal("57.0150")),
+    (Decimal("2.00"), Decimal("0.20"), Decimal("62.1225")),
+    (Decimal("2.00"), Decimal("0.20"), Decimal("62.1275")),
+    # Expected taxes end exactly with a half kopeck
+    (Decimal("0.50"), Decimal("0"), Decimal("1.0000")),
+    (Decimal("1.50"), Decimal("0"), Decimal("1.0000")),
+    # Amounts with more than 2 fractional digits
+    (Decimal("0.415"), Decimal("0.0415"), Decimal("57.6002")),
+    (Decimal("12.3456"), Decimal("1.23456"), Decimal("65.4321")),
+    # Paid taxes exceed the expected ones
+    (Decimal("10.00"), Decimal("3.00"), Decimal("60.0000")),
+    # Mocked currency rates
+    (Decimal("10.00"), Decimal("1.00"), Decimal()),
+])
+def test_dividend_rounding(automizer, value, paid_taxes, rate):
+    _check_dividend(automizer, value, paid_taxes, rate)
+
+
+def test_dividend_rounding_random(automizer):
+    rng = random.Random(0)
+
+    for _ in range(20000):
+        value = Decimal(rng.randint(1, 1000000)).scaleb(-rng.choice((2, 2, 2, 3, 4)))
+        paid_taxes = Decimal(rng.randint(0, 200000)).scaleb(-2)
+        rate = Decimal(rng.randint(300000, 900000)).scaleb(-4)
+        _check_dividend(automizer, value, paid_taxes, rate)
+
+
+def test_totals(automizer):
+    class CurrencyRates:
+        mock = False
+
+        def __init__(self):
+            self.requests = []
+
+        def get(self, date):
+            self.requests.append(date)
+            return Decimal("60.0000") if date.month == 1 else Decimal("70.0000")
+
+    january, february = datetime.date(2018, 1, 10), datetime.date(2018, 2, 10)
+    currency_rates = CurrencyRates()
+
+    income = automizer.BrokerageIncome("Broker", currency_rates, dividends=[
+        automizer.Dividend(january, "A", Decimal("1.00"), paid_taxes=Decimal("0.10")),
+        automizer.Dividend(january, "B", Decimal("2.00"), paid_taxes=Decimal("0.20")),
+        automizer.Dividend(february, "A", Decimal("3.00"), paid_taxes=Decimal("0.30")),
+    ])
+    assert sorted(currency_rates.requests) == [january, february]
+
+    totals = income.get_totals(lambda dividend: dividend.issuer)
+    assert list(totals) == ["A", "B"]
+    assert totals["A"].value_cents == 400
+    assert totals["A"].value_in_local_currency_kopecks == 6000 + 21000
+    assert totals["A"].paid_taxes_in_local_currency_kopecks == 600 + 2100
+    assert totals["A"].to_pay_kopecks == 180 + 630
@@ -0,0 +1,413 @@
+import csv
+import io
+import itertools
+import json
+import math
+import os
+import random
+import re
+import shutil
+
+from decimal import Decimal
+
+import pytest
+
+import investments_calc
+from investments_calc import (
+    Actions, CommissionSpec, Currency, Error, Formats, Holding, OrderExporter, Portfolio, SolverPosition, Solvers,
+    branch_and_bound, calculate, calculate_current_value, get_flat_holdings, load_config, process_portfolio,
+    solve_lp_relaxation)
+
+EXAMPLE_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), "investments-calc-example.toml")
+
+
+@pytest.fixture
+def config_path(tmp_path):
+    path = str(tmp_path / "portfolio.toml")
+    shutil.copy(EXAMPLE_CONFIG, path)
+    return path
+
+
+def _get_cache_files(cache_dir):
+    return [os.path.join(cache_dir, name) for name in os.listdir(cache_dir)]
+
+
+def _get_shares(holdings):
+    shares = {}
+
+    for holding in holdings:
+        if holding.is_group:
+            shares.update(_get_shares(holding.holdings))
+        else:
+            shares[holding.ticker] = (holding.current_shares, holding.selling_restricted, holding.buying_restricted)
+
+    return shares
+
+
+def test_config_cache(config_path, tmp_path, monkeypatch):
+    cache_dir = str(tmp_path / "cache")
+
+    portfolios, api_key = load_config(config_path, cache_dir)
+    assert api_key == ""
+    assert [portfolio.name for portfolio in portfolios] == ["IB"]
+    assert portfolios[0].tickers == {"VTI", "VGT", "VXUS", "BND", "BNDX"}
+    assert portfolios[0].commission_spec.calculate(100, Decimal(10)) == Decimal(1)
+    assert _get_shares(portfolios[0].holdings)["BNDX"] == (50, True, None)
+
+    cache_files = _get_cache_files(cache_dir)
+    assert len(cache_files) == 1
+
+    assert cache_files[0].endswith(".json")
+    with open(cache_files[0]) as cache_file:
+        compiled_config = json.load(cache_file)
+
+    # Only plain JSON data must be cached
+    def check_plain(value):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                assert isinstance(key, str)
+                check_plain(item)
+        elif isinstance(value, list):
+            for item in value:
+                check_plain(item)
+        else:
+            assert value is None or isinstance(value, (str, int, bool))
+
+    check_plain(compiled_config)
+
+    # Cached configs are neither parsed nor validated
+    def fail(*args, **kwargs):
+        raise AssertionError("The config is compiled again.")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(investments_calc, "compile_config", fail)
+        patch.setattr(investments_calc, "validate_portfolio", fail)
+
+        cached_portfolios, _ = load_config(config_path, cache_dir)
+
+    assert cached_portfolios[0].tickers == portfolios[0].tickers
+    assert cached_portfolios[0].commission_spec.calculate(100, Decimal(10)) == Decimal(1)
+    assert cached_portfolios[0].commission_spec.calculate(1000, Decimal(10)) == Decimal(5)
+    assert cached_portfolios[0].free_assets == portfolios[0].free_assets == Decimal(10000)
+    assert _get_shares(cached_portfolios[0].holdings) == _get_shares(portfolios[0].holdings)
+
+
+def test_corrupted_config_cache(config_path, tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    load_config(config_path, cache_dir)
+    cache_path, = _get_cache_files(cache_dir)
+
+    with open(cache_path) as cache_file:
+        compiled_config = json.load(cache_file)
+
+    compiled_config["portfolios"][0]["tickers"].append("UNKNOWN")
+    with open(cache_path, "w") as cache_file:
+        json.dump(compiled_config, cache_file)
+
+    portfolios, _ = load_config(config_path, cache_dir)
+    assert portfolios[0].tickers == {"VTI", "VGT", "VXUS", "BND", "BNDX"}
+
+    for garbage in (b"garbage", b"\xff", b"[]", b'{"api_key": "", "portfolios": [[]]}'):
+        with open(cache_path, "wb") as cache_file:
+            cache_file.write(garbage)
+
+        portfolios, _ = load_config(config_path, cache_dir)
+        assert portfolios[0].tickers == {"VTI", "VGT", "VXUS", "BND", "BNDX"}
+
+
+def test_invalid_config(config_path, tmp_path):
+    with open(config_path) as config_file:
+        config = config_file.read()
+
+    for old, new, error in (
+        ('weight = "30%"', 'weight = "31%"', "Invalid weights"),
+        ('ticker = "BND"', 'ticker = "BND X"', "holding ticker"),
+        ('shares = 40', 'shares = 40\nunknown = 1', "Unknown config.portfolios[0].holdings[1].holdings[0] options"),
+    ):
+        with open(config_path, "w") as config_file:
+            config_file.write(config.replace(old, new, 1))
+
+        with pytest.raises(Error, match=re.escape(error)):
+            load_config(config_path, str(tmp_path / "cache"))
+
+
+def _random_items(rng):
+    return [
+        [(rng.randint(0, 50), rng.randint(0, 30)) for _ in range(rng.randint(1, 4))]
+        for _ in range(rng.randint(1, 5))
+    ]
+
+
+def _brute_force(items, budget):
+    best_cost = None
+
+    for combination in itertools.product(*items):
+        cost, spent = sum(cost for cost, _ in combination), sum(spent for _, spent in combination)
+        if spent <= budget and (best_cost is None or cost < best_cost):
+            best_cost = cost
+
+    return best_cost
+
+
+def test_solve_lp_relaxation():
+    rng = random.Random(0)
+
+    for _ in range(500):
+        items = _random_items(rng)
+        budget = rng.randint(0, 100)
+
+        optimum = _brute_force(items, budget)
+        lower_bound, multiplier, choices = solve_lp_relaxation(items, budget)
+
+        if optimum is None:
+            assert lower_bound is None and multiplier is None and choices is None
+            continue
+
+        assert lower_bound <= optimum
+        assert sum(candidates[choice][1] for candidates, choice in zip(items, choices)) <= budget
+
+        # The multiplier must be the optimal solution of the Lagrangian dual, which is equal to the LP relaxation
+        assert multiplier >= 0
+        assert sum(min(cost + multiplier * spent for cost, spent in candidates) for candidates in items) - \
+            multiplier * budget == lower_bound
+
+
+def test_branch_and_bound():
+    rng = random.Random(1)
+
+    for _ in range(500):
+        items = _random_items(rng)
+        budget = rng.randint(0, 100)
+
+        optimum = _brute_force(items, budget)
+        _, multiplier, choices = solve_lp_relaxation(items, budget)
+        if optimum is None:
+            continue
+
+        best_choices = list(choices)
+        best_cost = sum(candidates[choice][0] for candidates, choice in zip(items, choices))
+
+        assert branch_and_bound(items, budget, multiplier, best_cost, best_choices, math.inf)
+        assert sum(candidates[choice][0] for candidates, choice in zip(items, best_choices)) == optimum
+        assert sum(candidates[choice][1] for candidates, choice in zip(items, best_choices)) <= budget
+
+
+def _random_portfolio(rng):
+    count = rng.randint(1, 3)
+    weights = [rng.randint(1, 20) for _ in range(count)]
+    percents = [(Decimal(weight * 100) / sum(weights)).quantize(Decimal("0.01")) for weight in weights]
+    percents[-1] += 100 - sum(percents)
+
+    holdings, prices = [], {}
+
+    for index, percent in enumerate(percents):
+        ticker = "T{}".format(index)
+        prices[ticker] = Decimal(rng.randint(2000, 9000)) / 100
+
+        holding = Holding("N{}".format(index), "{}%".format(percent), ticker, rng.randint(0, 8))
+        if rng.random() < 0.3:
+            holding.restrict_selling()
+        if rng.random() < 0.1:
+            holding.restrict_buying()
+        holdings.append(holding)
+
+    portfolio = Portfolio(
+        "P", Currency.USD, CommissionSpec(per_share="0.005", minimum=1, maximum_percent=1), holdings=holdings,
+        free_assets=rng.randint(0, 1500), min_free_assets=rng.choice([0, 50]), min_trade_volume=rng.choice([0, 0, 100]))
+    if rng.random() < 0.3:
+        portfolio.restrict_selling()
+
+    return portfolio, prices
+
+
+def _brute_force_portfolio(portfolio: Portfolio, prices):
+    calculate_current_value(portfolio.holdings, prices)
+
+    holdings = list(get_flat_holdings(portfolio.holdings))
+    total_value = sum(holding.current_value for holding, _, _ in holdings) + \
+        portfolio.free_assets - portfolio.min_free_assets
+    scale = total_value if total_value > 0 else Decimal(1)
+
+    values = []
+    for holding, expected_weight, _ in holdings:
+        position = SolverPosition(holding, total_value * expected_weight, (), scale, total_value,
+                                  portfolio.commission_spec, portfolio.min_trade_volume)
+        values.append([
+            position.evaluate(shares) for start, end in position.intervals for shares in range(start, end + 1)])
+
+    best_cost = _brute_force(values, total_value)
+    return None if best_cost is None else best_cost / scale
+
+
+def test_optimal_solver(monkeypatch):
+    for seed in range(300):
+        portfolio, prices = _random_portfolio(random.Random(seed))
+        optimum = _brute_force_portfolio(portfolio, prices)
+
+        monkeypatch.setattr(investments_calc, "get_prices", lambda tickers, api_key, fake_prices: prices)
+
+        portfolio, _ = _random_portfolio(random.Random(seed))
+        calculate(portfolio, "")
+        greedy_shares = [holding.shares for holding, _, _ in get_flat_holdings(portfolio.holdings)]
+
+        portfolio, _ = _random_portfolio(random.Random(seed))
+        calculate(portfolio, "", solver=Solvers.OPTIMAL, time_budget=60)
+        report = portfolio.solver_report
+
+        if optimum is None:
+            assert report.proven and report.lower_bound is None
+            continue
+
+        assert report.proven
+        assert report.cost == optimum
+        assert report.lower_bound <= report.cost
+        assert not report.greedy_feasible or report.cost <= report.greedy_cost
+
+        # The solver's trades must not be marked as blocked
+        for (holding, _, _), shares in zip(get_flat_holdings(portfolio.holdings), greedy_shares):
+            if holding.shares == shares:
+                continue
+
+            assert not (holding.shares < holding.current_shares and holding.sell_blocked)
+            assert not (holding.shares > holding.current_shares and holding.buy_blocked)
+
+
+def test_optimal_solver_time_budget(monkeypatch, capsys):
+    portfolio, prices = _random_portfolio(random.Random(1))
+    monkeypatch.setattr(investments_calc, "get_prices", lambda tickers, api_key, fake_prices: prices)
+
+    calculate(portfolio, "")
+    greedy_shares = [holding.shares for holding, _, _ in get_flat_holdings(portfolio.holdings)]
+
+    portfolio, _ = _random_portfolio(random.Random(1))
+    process_portfolio(Actions.REBALANCE, portfolio, "", False, solver=Solvers.OPTIMAL, time_budget=0)
+    report = portfolio.solver_report
+
+    # The greedy solution is kept without any bound
+    assert not report.proven and report.lower_bound is None
+    assert report.cost == report.greedy_cost
+    assert [holding.shares for holding, _, _ in get_flat_holdings(portfolio.holdings)] == greedy_shares
+
+    output = capsys.readouterr().out
+    assert "[time budget exceeded]" in output
+    assert "no feasible solution" not in output
+
+
+class _Output(io.StringIO):
+    def __init__(self):
+        super().__init__()
+        self.writes = 0
+
+    def write(self, string):
+        self.writes += 1
+        return super().write(string)
+
+    def isatty(self):
+        return False
+
+
+def _export_portfolio():
+    return Portfolio("P", Currency.USD, CommissionSpec(minimum=1), holdings=[
+        Holding("Stocks", "60%", holdings=[
+            Holding("USA", "50%", holdings=[
+                Holding("A", "100%", "A", 10),
+            ]),
+            Holding("B", "50%", "B", 0),
+        ]),
+        Holding("C", "40%", "C", 20).restrict_selling(),
+    ], free_assets=100, min_free_assets=0)
+
+
+def _export(monkeypatch, action, output_format):
+    prices = {"A": Decimal(10), "B": Decimal(5), "C": Decimal(10)}
+    monkeypatch.setattr(investments_calc, "get_prices",
+                        lambda tickers, api_key, fake_prices: {ticker: Decimal(1) for ticker in tickers}
+                        if fake_prices else prices)
+
+    output = _Output()
+    exporter = OrderExporter(output, output_format)
+
+    for portfolio in (_export_portfolio(), _export_portfolio()):
+        process_portfolio(action, portfolio, "", False, exporter)
+
+    # All portfolios are written at once
+    assert output.writes == 0
+    exporter.flush()
+    assert output.writes == 1
+
+    return output.getvalue()
+
+
+def test_csv_export(monkeypatch):
+    header, *rows = csv.reader(io.StringIO(_export(monkeypatch, Actions.REBALANCE, Formats.CSV)))
+    rows = [dict(zip(header, row)) for row in rows]
+
+    assert header[:4] == ["portfolio", "group", "name", "ticker"]
+    assert len(rows) == 6
+    assert [(row["group"], row["ticker"]) for row in rows[:3]] == [("Stocks / USA", "A"), ("Stocks", "B"), ("", "C")]
+
+    a, b, c = rows[:3]
+    assert (a["current_shares"], a["shares"], a["order"], a["order_shares"]) == ("10", "10", "", "0")
+    assert (b["current_shares"], b["shares"], b["order"], b["order_shares"]) == ("0", "19", "buy", "19")
+    assert (b["order_value"], b["commission"], b["expected_weight"]) == ("95", "1", "0.300000")
+
+    # C is overweighted, but selling is restricted
+    assert (c["order"], c["sell_blocked"], c["buy_blocked"]) == ("", "true", "false")
+
+
+def test_jsonl_export(monkeypatch):
+    rows = [json.loads(line) for line in _export(monkeypatch, Actions.REBALANCE, Formats.JSONL).splitlines()]
+
+    assert len(rows) == 6
+    assert rows[0]["portfolio"] == "P"
+    assert rows[1]["group"] == "Stocks"
+    assert (rows[1]["order"], rows[1]["order_shares"], rows[1]["weight"]) == ("buy", 19, "0.240506")
+    assert (rows[2]["sell_blocked"], rows[2]["buy_blocked"]) == (True, False)
+
+
+def test_show_export(monkeypatch):
+    # Positions are shown with fake prices, so there must be no orders
+    for output_format in (Formats.CSV, Formats.JSONL):
+        output = _export(monkeypatch, Actions.SHOW, output_format)
+
+        if output_format == Formats.CSV:
+            header, *rows = csv.reader(io.StringIO(output))
+            rows = [{key: value or None for key, value in zip(header, row)} for row in rows]
+        else:
+            rows = [json.loads(line) for line in output.splitlines()]
+
+        assert len(rows) == 6
+        for row in rows:
+            assert row["portfolio"] == "P" and row["ticker"] in ("A", "B", "C")
+            assert row["expected_weight"] is not None
+            assert all(row[key] is None for key in (
+                "price", "shares", "order", "order_shares", "order_value", "commission", "current_value", "value",
+                "current_weight", "weight", "sell_blocked", "buy_blocked"))
+
+        assert [row["current_shares"] for row in rows[:3]] == (
+            ["10", "0", "20"] if output_format == Formats.CSV else [10, 0, 20])
+
+
+def test_text_output_colors(monkeypatch):
+    prices = {"A": Decimal(10), "B": Decimal(5), "C": Decimal(10)}
+    monkeypatch.setattr(investments_calc, "get_prices", lambda tickers, api_key, fake_prices: prices)
+
+    def render(isatty):
+        output = _Output()
+        monkeypatch.setattr(output, "isatty", lambda: isatty)
+        monkeypatch.setattr(investments_calc.sys, "stdout", output)
+
+        investments_calc.colors_enabled.cache_clear()
+        try:
+            process_portfolio(Actions.REBALANCE, _export_portfolio(), "", False)
+        finally:
+            investments_calc.colors_enabled.cache_clear()
+
+        assert output.writes == 1
+        return output.getvalue()
+
+    assert "\x1b[" in render(True)
+
+    output = render(False)
+    assert "\x1b[" not in output
+    assert "* C (C) [sell blocked] - 20s " in output